@@ -1,31 +1,383 @@
 # pages/1_Upload_Image.py
 import streamlit as st
 import os
+import json
+import tempfile
+import time
+import numpy as np
+import cv2
 from PIL import Image
+import PIL.ExifTags as ExifTags
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import shutil
 
 # Create temp folder
 if not os.path.exists("temp_uploads"):
     os.makedirs("temp_uploads")
 
-st.markdown("<h3>STEP 1 - Upload Your Seed Tray Image</h3>", unsafe_allow_html=True)
+# Uploads and .npy decodes/warps of sessions that were abandoned are never
+# cleaned up by those sessions; drop any older than this
+STALE_TEMP_SECONDS = 24 * 3600
 
-uploaded = st.file_uploader("Choose an image (JPG/PNG)", type=["jpg", "jpeg", "png"])
+for name in os.listdir("temp_uploads"):
+    if name.startswith("upload_") or (name.startswith("tmp") and name.endswith(".npy")):
+        path = os.path.join("temp_uploads", name)
+        try:
+            if time.time() - os.path.getmtime(path) > STALE_TEMP_SECONDS:
+                os.remove(path)
+        except OSError:
+            pass
 
-if uploaded:
-    # Save image
-    img = Image.open(uploaded)
-    filepath = f"temp_uploads/{uploaded.name}"
-    img.save(filepath)
+# Index of previously processed trays, one JSON entry per line
+# (appended by Step 6; must match HASH_INDEX_PATH in pages/6_Export.py)
+HASH_INDEX_PATH = "temp_uploads/hash_index.jsonl"
+# Max number of differing hash bits for two images to count as the same tray
+DUPLICATE_MAX_DISTANCE = 10
+# Max relative aspect-ratio change for saved corners to be rescaled and reused
+ASPECT_TOLERANCE = 0.01
 
-    # Store in session state
-    st.session_state.image_path = filepath
-    st.session_state.original_image = img
+# Number of queued trays decoded in the background ahead of the current one
+PREFETCH_AHEAD = 2
+PREVIEW_MAX_SIDE = 2000
 
-    st.success(f"Uploaded successfully: {uploaded.name}")
-    st.image(img, caption="Your seed tray", width=200)
-    
-    if st.button("Next", type="primary"):
+# Above this size the full decode goes to an on-disk .npy (memory-mapped) and
+# only the preview proxy is held in memory; Step 3 then warps it tile by tile
+LARGE_IMAGE_PIXELS = 50_000_000
+# Flatbed/stitched scans exceed Pillow's default decompression-bomb limit
+# (~179 MP); allow up to 1 GP (Pillow raises at twice this value)
+Image.MAX_IMAGE_PIXELS = 500_000_000
+
+# Per-image state that must not leak from one tray into the next
+PER_IMAGE_KEYS = [
+    "rotated_image", "rotated_bgr", "final_rotation", "points",
+    "warped_bgr", "warped_rgb", "warp_key", "metadata", "grid", "final_grid",
+    "restored_grid", "duplicate_of", "decoded_rgb", "warped_proxy_rgb",
+]
+
+
+# ============================================================
+# Perceptual hash (DCT pHash) on a downsampled decode
+# ============================================================
+def perceptual_hash(img, hash_size=8, highfreq_factor=4):
+    img_size = hash_size * highfreq_factor
+    # Hashed from the preview proxy, so the full image is never decoded for it
+    img = img.convert("L").resize((img_size, img_size), Image.Resampling.LANCZOS)
+
+    dct = cv2.dct(np.asarray(img, dtype=np.float32))
+    low = dct[:hash_size, :hash_size].flatten()
+    # Skip the DC term so overall brightness does not dominate the median
+    bits = low > np.median(low[1:])
+
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+# ============================================================
+# BK-tree: Hamming-distance lookup without scanning the whole index
+# ============================================================
+class BKTree:
+    def __init__(self):
+        self.root = None  # (hash, entry, {distance: child})
+
+    def add(self, value, entry):
+        if self.root is None:
+            self.root = (value, entry, {})
+            return
+        node = self.root
+        while True:
+            d = hamming(value, node[0])
+            if d == 0:
+                return
+            if d not in node[2]:
+                node[2][d] = (value, entry, {})
+                return
+            node = node[2][d]
+
+    def nearest(self, value, max_distance):
+        best, best_d = None, max_distance + 1
+        stack = [self.root] if self.root else []
+        while stack:
+            node_value, entry, children = stack.pop()
+            d = hamming(value, node_value)
+            if d < best_d:
+                best, best_d = entry, d
+            # Triangle inequality: only subtrees within the search radius can match
+            for child_d, child in children.items():
+                if d - best_d < child_d < d + best_d:
+                    stack.append(child)
+        return best, best_d
+
+
+# The tree is rebuilt only when Step 6 has appended to the index file
+@st.cache_resource(max_entries=1)
+def load_hash_index(mtime):
+    entries = {}
+    if os.path.exists(HASH_INDEX_PATH):
+        with open(HASH_INDEX_PATH) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # skip a line still being appended
+                # Re-exports of the same tray: the latest entry wins
+                entries[entry["hash"]] = entry
+
+    tree = BKTree()
+    for entry in entries.values():
+        tree.add(int(entry["hash"], 16), entry)
+    return tree
+
+
+def find_duplicate(image_hash):
+    mtime = os.stat(HASH_INDEX_PATH).st_mtime_ns if os.path.exists(HASH_INDEX_PATH) else 0
+    return load_hash_index(mtime).nearest(int(image_hash, 16), DUPLICATE_MAX_DISTANCE)
+
+
+# Corners are stored in pixels of the rotated image they were clicked on.
+# Rescale them to this upload (e.g. a re-saved smaller copy), or drop them if
+# its aspect ratio differs, since they would no longer hit the tray corners.
+def restored_points(entry, image_size):
+    if "size" not in entry:
+        return []
+    w, h = image_size
+    if entry["rotation"] in (90, 270):
+        w, h = h, w
+    old_w, old_h = entry["size"]
+    sx, sy = w / old_w, h / old_h
+    if abs(sx / sy - 1) > ASPECT_TOLERANCE:
+        return []
+    return [(int(round(x * sx)), int(round(y * sy))) for x, y in entry["points"]]
+
+
+# Parsed from the raw EXIF block: for PNG, img.getexif() would first decode
+# the whole image
+def read_exif_date(img):
+    try:
+        exif = Image.Exif()
+        if "exif" in img.info:
+            exif.load(img.info["exif"])
+        if exif:
+            for tag_id, value in exif.items():
+                tag = ExifTags.TAGS.get(tag_id, tag_id)
+                if tag == "DateTimeOriginal":
+                    return datetime.strptime(value, "%Y:%m:%d %H:%M:%S").date()
+    except Exception:
+        pass
+    return None
+
+
+def make_preview(img):
+    scale = min(PREVIEW_MAX_SIDE / max(img.size), 1.0)
+    size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+    return img.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0).convert("RGB")
+
+
+# ============================================================
+# Out-of-core decode for large scans
+# ============================================================
+# Pillow stores L as 1 byte and RGB/RGBA as 4 bytes per pixel. Pointing the
+# image at a memmap with that layout makes the decoder write rows straight
+# to disk, so the full image is never held in memory. This relies on
+# ImageFile.load() keeping a pre-set `im` (checked on Pillow 9.5-12.3, see
+# requirements.txt); if a release stops doing that, fall back to a copy.
+def decode_to_memmap(path):
+    fd, out_path = tempfile.mkstemp(dir="temp_uploads", suffix=".npy")
+    os.close(fd)
+    with Image.open(path) as img:
+        w, h = img.size
+        if img.mode in ("L", "RGB", "RGBA"):
+            shape = (h, w) if img.mode == "L" else (h, w, 4)
+            mm = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.uint8, shape=shape)
+            target = Image.core.map_buffer(mm, img.size, "raw", 0, (img.mode, 0, 1))
+            img.im = target
+            img.load()
+            if img.im is not target:
+                channels = len(img.getbands())
+                mm.reshape(h, w, -1)[..., :channels] = np.asarray(img).reshape(h, w, channels)
+        else:
+            # Palette, bilevel and 16-bit scans have no such layout: decode once in memory
+            mm = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.uint8, shape=(h, w, 4))
+            mm[..., :3] = np.asarray(img.convert("RGB"))
+    mm.flush()
+    del mm
+    return out_path
+
+
+# Zero-copy RGB view of a decode_to_memmap() result
+def decoded_rgb_view(decoded):
+    if decoded.ndim == 2:
+        return np.broadcast_to(decoded[..., None], decoded.shape + (3,))
+    return decoded[..., :3]
+
+
+# Remove this session's on-disk decode/warp of the tray being replaced.
+# Open memmaps stay valid after the unlink; the space is freed once they close.
+def discard_image_files():
+    for key in ["decoded_path", "warped_path"]:
+        path = st.session_state.pop(key, None)
+        if path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# ============================================================
+# Background tray loading (runs in a worker thread – no st.* calls here)
+# ============================================================
+# Normal trays are fully decoded here so Step 2 does not wait for them
+# (PREFETCH_AHEAD bounds how many are held); large scans are streamed to
+# disk and only their preview proxy stays in memory.
+def load_tray(path):
+    img = Image.open(path)
+    tray = {"path": path, "exif_date": read_exif_date(img)}
+    if img.width * img.height > LARGE_IMAGE_PIXELS:
+        img.close()
+        tray["decoded_path"] = decode_to_memmap(path)
+        rgb = decoded_rgb_view(np.load(tray["decoded_path"], mmap_mode="r"))
+        step = -(-max(img.size) // PREVIEW_MAX_SIDE)
+        tray["preview"] = Image.fromarray(np.ascontiguousarray(rgb[::step, ::step]))
+    else:
+        img.load()
+        tray["image"] = img
+        tray["preview"] = make_preview(img)
+    tray["hash"] = f"{perceptual_hash(tray['preview']):016x}"
+    return tray
+
+
+# Delete the on-disk decode of a prefetched tray that will never be used
+def discard_prefetched(future):
+    if not future.cancelled() and future.exception() is None:
+        path = future.result().get("decoded_path")
+        if path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# One bounded pool for the whole server rather than one per browser session
+@st.cache_resource
+def get_prefetch_pool():
+    return ThreadPoolExecutor(max_workers=2)
+
+
+def schedule_prefetch(queue, pos):
+    pool = get_prefetch_pool()
+    futures = st.session_state.setdefault("prefetch", {})
+    # Forget trays already taken over by the session (it owns their files now)
+    for done in [i for i in futures if i < pos]:
+        del futures[done]
+    for i in range(pos, min(pos + 1 + PREFETCH_AHEAD, len(queue))):
+        if i not in futures:
+            futures[i] = pool.submit(load_tray, queue[i]["path"])
+    return futures
+
+
+st.markdown("<h3>STEP 1 - Upload Your Seed Tray Images</h3>", unsafe_allow_html=True)
+
+uploads = st.file_uploader(
+    "Choose one or more images (JPG/PNG)",
+    type=["jpg", "jpeg", "png"],
+    accept_multiple_files=True,
+)
+
+# A new selection of files replaces the work queue
+if uploads:
+    batch_id = tuple(u.file_id for u in uploads)
+    if st.session_state.get("batch_id") != batch_id:
+        # Unique file per upload: batches often repeat camera names (DSC_0001.jpg)
+        queue = []
+        for u in uploads:
+            fd, filepath = tempfile.mkstemp(dir="temp_uploads", prefix="upload_",
+                                            suffix=os.path.splitext(u.name)[1])
+            with os.fdopen(fd, "wb") as f:
+                f.write(u.getbuffer())
+            queue.append({"path": filepath, "name": u.name})
+
+        st.session_state.batch_id = batch_id
+        st.session_state.tray_queue = queue
+        st.session_state.queue_pos = 0
+        # Stop work on the replaced batch and clean up whatever it produced
+        for future in st.session_state.pop("prefetch", {}).values():
+            future.cancel()
+            future.add_done_callback(discard_prefetched)
+
+if st.session_state.get("tray_queue"):
+    queue = st.session_state.tray_queue
+    pos = st.session_state.queue_pos
+    futures = schedule_prefetch(queue, pos)
+
+    # Only load each tray once (Streamlit reruns this script on every click)
+    tray_id = (st.session_state.batch_id, pos)
+    if st.session_state.get("tray_id") != tray_id:
+        with st.spinner("Loading tray..."):
+            try:
+                tray = futures[pos].result()
+            except Exception as e:
+                st.error(f"Could not load {queue[pos]['name']}: {e}")
+                if pos + 1 < len(queue) and st.button("Skip this tray"):
+                    st.session_state.queue_pos = pos + 1
+                    st.rerun()
+                st.stop()
+
+        discard_image_files()
+        for key in PER_IMAGE_KEYS:
+            st.session_state.pop(key, None)
+
+        # Store in session state
+        st.session_state.tray_id = tray_id
+        st.session_state.image_path = tray["path"]
+        st.session_state.image_name = queue[pos]["name"]
+        # Large scans: lazy handle, their pixels live in the memmap below
+        st.session_state.original_image = tray["image"] if "image" in tray else Image.open(tray["path"])
+        st.session_state.preview_image = tray["preview"]
+        st.session_state.exif_date = tray["exif_date"]
+        st.session_state.image_hash = tray["hash"]
+        if "decoded_path" in tray:
+            st.session_state.decoded_path = tray["decoded_path"]
+            st.session_state.decoded_rgb = decoded_rgb_view(np.load(tray["decoded_path"], mmap_mode="r"))
+
+        match, distance = find_duplicate(tray["hash"])
+        if match:
+            st.session_state.duplicate_of = match
+
+        # Coming from Step 6 "Next Tray": go straight on unless there is a duplicate to resolve
+        if st.session_state.pop("auto_advance", False) and not match:
+            st.switch_page("pages/2_Rotate_Image.py")
+
+    st.success(f"Tray {pos + 1} of {len(queue)}: {st.session_state.image_name}")
+    st.image(st.session_state.preview_image, caption="Your seed tray", width=200)
+
+    # ------------------------------------------------------------------
+    # Duplicate of a previously processed tray → offer to reuse its work
+    # ------------------------------------------------------------------
+    match = st.session_state.get("duplicate_of")
+    if match:
+        st.warning(
+            f"This image looks like **{match['name']}**, processed on {match['saved_at'][:10]} "
+            f"({match['metadata']['crop']}, {match['metadata']['nrows']}×{match['metadata']['ncols']})."
+        )
+        col_load, col_new = st.columns(2)
+        with col_load:
+            if st.button("Load previous rotation, corners & grid", type="primary", use_container_width=True):
+                st.session_state.final_rotation = match["rotation"]
+                st.session_state.points = restored_points(match, st.session_state.original_image.size)
+                st.session_state.restored_grid = match["grid"]
+                st.session_state.pop("duplicate_of", None)
+                st.switch_page("pages/2_Rotate_Image.py")
+        with col_new:
+            if st.button("Start over", use_container_width=True):
+                st.session_state.pop("duplicate_of", None)
+                st.rerun()
+    elif st.button("Next", type="primary"):
         st.switch_page("pages/2_Rotate_Image.py")
 else:
-    st.info("Please upload an image to continue")
+    st.info("Please upload one or more images to continue")
@@ -13,7 +13,16 @@ if "original_image" not in st.session_state:
         st.switch_page("pages/1_Upload_Image.py")
     st.stop()
 
-img = st.session_state.original_image.copy()
+img = st.session_state.original_image
+# Large scans: memory-mapped full-resolution RGB decoded by Step 1
+decoded_rgb = st.session_state.get("decoded_rgb")
+
+# Rotate the small proxy built by Step 1 for the preview instead of the full image
+preview_src = st.session_state.preview_image
+
+# Pre-select a rotation restored from a previously processed duplicate (Step 1)
+ROTATIONS = [0, 90, 180, 270]
+previous_rotation = st.session_state.get("final_rotation", 0)
 
 st.subheader("Choose correct orientation")
 col1, col2 = st.columns([1, 3])
@@ -21,16 +30,26 @@ col1, col2 = st.columns([1, 3])
 with col1:
     rotation = st.radio(
         "Rotate Image",
-        options=[0, 90, 180, 270],
+        options=ROTATIONS,
         format_func=lambda x: f"{x}°",
-        index=0,
+        index=ROTATIONS.index(previous_rotation),
         key="rotation_choice"
     )
     if st.button("Next", type="primary", use_container_width=True):
-        rotated = img.rotate(-rotation, expand=True)
-        rotated_rgb = np.array(rotated)
-        rotated_bgr = cv2.cvtColor(rotated_rgb, cv2.COLOR_RGB2BGR)
+        if decoded_rgb is not None:
+            # Zero-copy views on the memory-mapped decode: rot90 is clockwise
+            # for negative k, and reversing the channel axis gives BGR
+            rotated_bgr = np.rot90(decoded_rgb, -rotation // 90)[..., ::-1]
+            rotated = preview_src.rotate(-rotation, expand=True)
+        else:
+            rotated = img.rotate(-rotation, expand=True)
+            rotated_rgb = np.array(rotated)
+            rotated_bgr = cv2.cvtColor(rotated_rgb, cv2.COLOR_RGB2BGR)
         
+        # Corners clicked for another orientation no longer fit the image
+        if rotation != previous_rotation:
+            st.session_state.points = []
+
         st.session_state.rotated_image = rotated
         st.session_state.rotated_bgr = rotated_bgr
         st.session_state.final_rotation = rotation
@@ -39,7 +58,7 @@ with col1:
         st.switch_page("pages/3_Perspective_Correction.py")
 
 with col2:
-    rotated_preview = img.rotate(-rotation, expand=True)
+    rotated_preview = preview_src.rotate(-rotation, expand=True)
     st.image(rotated_preview, width=400, caption=f"Preview: {rotation}° rotation")
 
 st.info("Tip: Make sure Row 1 is at the top and Column 1 is on the left.")
@@ -1,5 +1,7 @@
 # pages/3_Perspective_Correction.py
 import streamlit as st
+import os
+import tempfile
 import numpy as np
 import cv2
 from PIL import Image
@@ -8,7 +10,7 @@ from streamlit_image_coordinates import streamlit_image_coordinates
 # ============================================================
 # NEW: Perspective correction logic with buffer
 # ============================================================
-def four_point_transform_with_buffer(img, pts):
+def buffered_homography(pts):
     pts = np.array(pts, dtype="float32")
     tl, tr, br, bl = pts
 
@@ -38,10 +40,69 @@ def four_point_transform_with_buffer(img, pts):
     ], dtype="float32")
 
     M = cv2.getPerspectiveTransform(pts, dst)
-    warped = cv2.warpPerspective(img, M, (finalW, finalH))
+    return M, (finalW, finalH)
+
+
+def four_point_transform_with_buffer(img, pts):
+    M, size = buffered_homography(pts)
+    warped = cv2.warpPerspective(img, M, size)
     return warped
 
 
+# ============================================================
+# Tiled out-of-core variant for very large scans
+# ============================================================
+# Same result as four_point_transform_with_buffer (bilinear, black border),
+# but each output tile is produced with cv2.remap from only the source
+# window it maps onto, and written straight into an on-disk .npy. Peak
+# memory is bounded by the tile size, so `img` can be a memory-mapped array.
+def four_point_transform_tiled(img, pts, out_path, tile=1024):
+    M, (finalW, finalH) = buffered_homography(pts)
+    M_inv = np.linalg.inv(M)
+    src_h, src_w = img.shape[:2]
+
+    # Freshly created .npy files are zero-filled, i.e. already the border colour
+    out = np.lib.format.open_memmap(out_path, mode="w+", dtype=img.dtype,
+                                    shape=(finalH, finalW) + img.shape[2:])
+
+    for y0 in range(0, finalH, tile):
+        for x0 in range(0, finalW, tile):
+            y1, x1 = min(y0 + tile, finalH), min(x0 + tile, finalW)
+
+            # Inverse-map output pixel centres to source coordinates
+            xs, ys = np.meshgrid(np.arange(x0, x1, dtype=np.float64),
+                                 np.arange(y0, y1, dtype=np.float64))
+            w = M_inv[2, 0] * xs + M_inv[2, 1] * ys + M_inv[2, 2]
+            w = np.divide(1.0, w, out=np.zeros_like(w), where=w != 0)
+            map_x = (M_inv[0, 0] * xs + M_inv[0, 1] * ys + M_inv[0, 2]) * w
+            map_y = (M_inv[1, 0] * xs + M_inv[1, 1] * ys + M_inv[1, 2]) * w
+
+            # Pixels that touch the source at all (bilinear reaches 1px out)
+            valid = (map_x > -1) & (map_x < src_w) & (map_y > -1) & (map_y < src_h)
+            if not valid.any():
+                continue
+
+            # Smallest source window covering this tile, incl. right/bottom neighbours
+            sx0 = max(int(np.floor(map_x[valid].min())), 0)
+            sy0 = max(int(np.floor(map_y[valid].min())), 0)
+            sx1 = min(int(np.floor(map_x[valid].max())) + 2, src_w)
+            sy1 = min(int(np.floor(map_y[valid].max())) + 2, src_h)
+            region = np.ascontiguousarray(img[sy0:sy1, sx0:sx1])
+
+            out[y0:y1, x0:x1] = cv2.remap(
+                region,
+                (map_x - sx0).astype(np.float32),
+                (map_y - sy0).astype(np.float32),
+                cv2.INTER_LINEAR,
+                borderMode=cv2.BORDER_CONSTANT,
+                borderValue=0,
+            )
+
+    out.flush()
+    del out
+    return np.load(out_path, mmap_mode="r")
+
+
 # ============================================================
 # UI SECTION
 # ============================================================
@@ -57,8 +118,11 @@ if "rotated_bgr" not in st.session_state or "rotated_image" not in st.session_st
         st.switch_page("pages/2_Rotate_Image.py")
     st.stop()
 
-img_bgr = st.session_state.rotated_bgr.copy()
+# Warping never writes to the source, so no copy (it may be a memmap view)
+img_bgr = st.session_state.rotated_bgr
 pil_img = st.session_state.rotated_image.copy()
+# Step 1 decoded large scans to disk; rotated_bgr is then a memmap view
+is_large = st.session_state.get("decoded_rgb") is not None
 
 if "points" not in st.session_state:
     st.session_state.points = []
@@ -67,7 +131,10 @@ if "points" not in st.session_state:
 # Point selection UI (unchanged)
 # ------------------------------------------------------------------
 MAX_DISPLAY_WIDTH = 800
-orig_w, orig_h = pil_img.size
+# Large scans: max side of the downsampled copy Steps 4-6 work on
+PROXY_MAX_SIDE = 4000
+# Full-resolution size: for large scans pil_img is only a downscaled proxy
+orig_h, orig_w = img_bgr.shape[:2]
 scale = min(MAX_DISPLAY_WIDTH / orig_w, 1.0)
 display_img = pil_img.copy()
 if scale < 1:
@@ -120,30 +187,66 @@ if len(st.session_state.points) == 4:
             st.rerun()
         st.stop()
 
-    # Actual warp using NEW logic
-    with st.spinner("Applying perspective correction..."):
-        try:
-            warped_bgr = four_point_transform_with_buffer(img_bgr, st.session_state.points)
-            warped_rgb = cv2.cvtColor(warped_bgr, cv2.COLOR_BGR2RGB)
+    # Actual warp using NEW logic (skipped on reruns if nothing changed)
+    warp_key = (st.session_state.get("final_rotation"), tuple(st.session_state.points))
+    if st.session_state.get("warp_key") != warp_key or "warped_bgr" not in st.session_state:
+        with st.spinner("Applying perspective correction..."):
+            warped_path = None
+            try:
+                if is_large:
+                    # Fresh file per warp: the previous output may still be mapped
+                    fd, warped_path = tempfile.mkstemp(dir="temp_uploads", suffix=".npy")
+                    os.close(fd)
+                    warped_bgr = four_point_transform_tiled(img_bgr, st.session_state.points, warped_path)
+                    warped_rgb = warped_bgr[..., ::-1]
+
+                    old_path = st.session_state.get("warped_path")
+                    if old_path:
+                        try:
+                            os.remove(old_path)
+                        except OSError:
+                            pass
+                    st.session_state.warped_path = warped_path
+                else:
+                    warped_bgr = four_point_transform_with_buffer(img_bgr, st.session_state.points)
+                    warped_rgb = cv2.cvtColor(warped_bgr, cv2.COLOR_BGR2RGB)
+
+                st.session_state.warped_bgr = warped_bgr
+                st.session_state.warped_rgb = warped_rgb
+                st.session_state.warp_key = warp_key
+
+                # Steps 4-6 display/annotate this instead of the full memmap
+                if is_large:
+                    step = -(-max(warped_rgb.shape[:2]) // PROXY_MAX_SIDE)
+                    st.session_state.warped_proxy_rgb = np.ascontiguousarray(warped_rgb[::step, ::step])
+                else:
+                    st.session_state.warped_proxy_rgb = warped_rgb
+            except Exception as e:
+                if warped_path and warped_path != st.session_state.get("warped_path"):
+                    try:
+                        os.remove(warped_path)
+                    except OSError:
+                        pass
+                st.error(f"Warping failed: {e}")
+                st.stop()
 
-            st.session_state.warped_bgr = warped_bgr
-            st.session_state.warped_rgb = warped_rgb
+    warped_rgb = st.session_state.warped_rgb
+    st.success("Perspective correction successful!")
 
-            st.success("Perspective correction successful!")
-        except Exception as e:
-            st.error(f"Warping failed: {e}")
-            st.stop()
+    # Preview from a strided subsample so large outputs are never fully loaded
+    step = max(1, max(warped_rgb.shape[:2]) // MAX_DISPLAY_WIDTH)
+    warped_preview = np.ascontiguousarray(warped_rgb[::step, ::step])
 
     # Preview
     col1, col2 = st.columns(2, gap="large")
     with col1:
         st.image(pil_img, caption="Rotated", width=400)
     with col2:
-        st.image(warped_rgb, caption="Corrected & Ready", width=400)
+        st.image(warped_preview, caption="Corrected & Ready", width=400)
 
     if st.button("Redo Perspective Correction", type="secondary"):
         st.session_state.points = []
-        for key in ["warped_bgr", "warped_rgb"]:
+        for key in ["warped_bgr", "warped_rgb", "warped_proxy_rgb", "warp_key"]:
             st.session_state.pop(key, None)
         st.rerun()
 
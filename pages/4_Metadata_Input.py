@@ -2,7 +2,6 @@
 import streamlit as st
 from datetime import datetime, timedelta
 from PIL import Image
-import PIL.ExifTags as ExifTags
 
 st.set_page_config(layout="wide", page_title="Seed Tray Annotator")
 
@@ -25,32 +24,21 @@ st.markdown("<h3>STEP 4 – Photograph & Tray Details</h3>", unsafe_allow_html=T
 # ---------------------------------------------------------
 # Safety check: Must have perspective-corrected image
 # ---------------------------------------------------------
-if "warped_rgb" not in st.session_state:
+if "warped_proxy_rgb" not in st.session_state:
     st.error("No corrected image found! Please complete Perspective Correction first.")
     if st.button("Back to Perspective Correction"):
         st.switch_page("pages/3_Perspective_Correction.py")
     st.stop()
 
-# Final corrected image (RGB PIL Image)
-img_display = Image.fromarray(st.session_state.warped_rgb)
+# Final corrected image (RGB PIL Image; downsampled copy for large scans)
+img_display = Image.fromarray(st.session_state.warped_proxy_rgb)
 
-# ---------------------------------------------------------
-# Try to read EXIF date from the ORIGINAL uploaded image (warping removes EXIF)
-# ---------------------------------------------------------
-def extract_exif_date_from_original():
-    if "original_image" in st.session_state:
-        try:
-            exif = st.session_state.original_image.getexif()
-            if exif:
-                for tag_id, value in exif.items():
-                    tag = ExifTags.TAGS.get(tag_id, tag_id)
-                    if tag == "DateTimeOriginal":
-                        return datetime.strptime(value, "%Y:%m:%d %H:%M:%S").date()
-        except Exception:
-            pass
-    return None
-
-exif_date = extract_exif_date_from_original()
+# EXIF capture date of the ORIGINAL upload (warping removes EXIF), read by
+# Step 1 when the tray was queued
+exif_date = st.session_state.get("exif_date")
+
+# Metadata of the previous tray in the queue, used to pre-fill the form
+previous = st.session_state.get("previous_metadata", {})
 
 # ---------------------------------------------------------
 # Main layout: image + form
@@ -69,26 +57,35 @@ with col_form:
         st.warning("No EXIF date found → Please enter manually")
         capture_date = st.date_input("Capture Date", value=datetime.today().date(), key="capture_manual")
 
+    # Grid restored from a previously processed duplicate (Step 1)
+    restored_grid = st.session_state.get("restored_grid")
+
     st.subheader("Tray Layout")
     t1, t2 = st.columns(2)
     with t1:
-        nrows = st.number_input("Rows", min_value=1, value=14, step=1)
+        nrows = st.number_input("Rows", min_value=1, value=len(restored_grid) if restored_grid else previous.get("nrows", 14), step=1)
     with t2:
-        ncols = st.number_input("Columns", min_value=1, value=7, step=1)
+        ncols = st.number_input("Columns", min_value=1, value=len(restored_grid[0]) if restored_grid else previous.get("ncols", 7), step=1)
 
-    shape = st.selectbox("Cavity Shape", ["Circle", "Square", "Rectangle", "Hexagon", "Other"])
+    shapes = ["Circle", "Square", "Rectangle", "Hexagon", "Other"]
+    shape = st.selectbox("Cavity Shape", shapes, index=shapes.index(previous.get("shape", "Circle")))
 
     st.subheader("Seedling Details")
     s1, s2 = st.columns(2)
     with s1:
+        crops = ["Tomato", "Cucumber", "Hot Pepper", "Cabbage", "Lettuce", "Eggplant", "Other"]
         crop = st.selectbox(
             "Crop",
-            ["Tomato", "Cucumber", "Hot Pepper", "Cabbage", "Lettuce", "Eggplant", "Other"],
-            index=0
+            crops,
+            index=crops.index(previous.get("crop", "Tomato"))
         )
     with s2:
-        # Default sowing date = 14 days before capture
+        # Default sowing date = previous tray's if still valid, else 14 days before capture
         default_sowing = capture_date - timedelta(days=14)
+        if "sowing_date" in previous:
+            previous_sowing = datetime.strptime(previous["sowing_date"], "%Y-%m-%d").date()
+            if previous_sowing < capture_date:
+                default_sowing = previous_sowing
         sowing_date = st.date_input("Date of Sowing", value=default_sowing)
 
     # -----------------------------------------------------
@@ -129,8 +126,12 @@ with col_form:
             "filename_base": filename_base,
         }
 
-        # Initialize empty annotation grid (G = Germinated/Healthy by default)
-        st.session_state.grid = [["G" for _ in range(int(ncols))] for _ in range(int(nrows))]
+        # Reuse the restored grid if the layout still matches, otherwise
+        # initialize empty annotation grid (G = Germinated/Healthy by default)
+        if restored_grid and len(restored_grid) == int(nrows) and len(restored_grid[0]) == int(ncols):
+            st.session_state.grid = [row.copy() for row in restored_grid]
+        else:
+            st.session_state.grid = [["G" for _ in range(int(ncols))] for _ in range(int(nrows))]
 
         # Change this to whatever your next page is called
         st.switch_page("pages/5_Annotation_Grid.py")
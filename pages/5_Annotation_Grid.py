@@ -10,14 +10,15 @@ st.markdown("**Annotation Cycle:** Click anywhere on the expanded view → **G 
 # ------------------------------------------------------------------
 # Safety check
 # ------------------------------------------------------------------
-if "warped_rgb" not in st.session_state:
+if "warped_proxy_rgb" not in st.session_state:
     st.error("No corrected image found! Please complete previous steps.")
     if st.button("← Back to Metadata"):
         st.switch_page("pages/4_Metadata_Input.py")
     st.stop()
 
 # Load final corrected image
-full_img = Image.fromarray(st.session_state.warped_rgb)
+# (downsampled copy for large scans, so each click does not copy the full memmap)
+full_img = Image.fromarray(st.session_state.warped_proxy_rgb)
 W, H = full_img.size
 
 # Grid settings from metadata
@@ -4,6 +4,7 @@ import cv2
 import numpy as np
 from PIL import Image
 import json
+import os
 from datetime import datetime
 import zipfile
 from io import BytesIO
@@ -14,7 +15,7 @@ st.markdown("<h2 style='text-align: center;'>STEP 6 – Review & Export</h2>", u
 # ------------------------------------------------------------------
 # Safety check
 # ------------------------------------------------------------------
-required_keys = ["original_image", "warped_bgr", "warped_rgb", "metadata", "final_grid"]
+required_keys = ["original_image", "warped_bgr", "warped_proxy_rgb", "metadata", "final_grid"]
 missing = [k for k in required_keys if k not in st.session_state]
 if missing:
     st.error(f"Missing data: {', '.join(missing)}. Please complete previous steps.")
@@ -23,24 +24,24 @@ if missing:
     st.stop()
 
 original_img = st.session_state.original_image  # PIL
-warped_bgr = st.session_state.warped_bgr.copy()  # cv2 BGR
-warped_rgb = st.session_state.warped_rgb.copy()  # np RGB (clean)
+warped_bgr = st.session_state.warped_bgr  # cv2 BGR (memmap for large scans – never copied)
+proxy_rgb = st.session_state.warped_proxy_rgb  # np RGB, downsampled for large scans
 metadata = st.session_state.metadata
 grid = st.session_state.final_grid
 
 nrows = metadata["nrows"]
 ncols = metadata["ncols"]
 
-# Total padded grid: 16x9
+# Total padded grid: 16x9 (cells measured on the preview image)
 TOTAL_ROWS, TOTAL_COLS = 16, 9
-H, W = warped_bgr.shape[:2]
+H, W = proxy_rgb.shape[:2]
 cell_h = H // TOTAL_ROWS
 cell_w = W // TOTAL_COLS
 
 # ------------------------------------------------------------------
 # Create overlaid (preview) image with colored borders
 # ------------------------------------------------------------------
-overlaid_bgr = warped_bgr.copy()
+overlaid_bgr = cv2.cvtColor(proxy_rgb, cv2.COLOR_RGB2BGR)
 border_colors = {
     "G": (0, 255, 0),    # Green
     "A": (255, 165, 0),  # Orange
@@ -59,9 +60,6 @@ for rr, r in enumerate(range(nrows)):
 
 overlaid_rgb = cv2.cvtColor(overlaid_bgr, cv2.COLOR_BGR2RGB)
 
-# Clean corrected image (for download)
-clean_corrected_pil = Image.fromarray(warped_rgb)
-
 # ------------------------------------------------------------------
 # UI: Show overlaid preview + inputs
 # ------------------------------------------------------------------
@@ -124,20 +122,53 @@ json_data = {
 
 json_str = json.dumps(json_data, indent=2)
 
+# ------------------------------------------------------------------
+# Duplicate index read by Step 1 (updated once the bundle is exported)
+# ------------------------------------------------------------------
+# Must match HASH_INDEX_PATH in pages/1_Upload_Image.py
+HASH_INDEX_PATH = "temp_uploads/hash_index.jsonl"
+
+
+def record_in_hash_index():
+    # Corners are in pixels of the rotated image, so keep its size to rescale them
+    rotated_h, rotated_w = st.session_state.rotated_bgr.shape[:2]
+    entry = {
+        "hash": st.session_state.image_hash,
+        "name": st.session_state.get("image_name", ""),
+        "saved_at": json_data["saved_at"],
+        "rotation": st.session_state.get("final_rotation", 0),
+        "size": [rotated_w, rotated_h],
+        "points": [list(p) for p in st.session_state.get("points", [])],
+        "grid": grid,
+        "metadata": json_data["metadata"],
+    }
+
+    # Append-only, one write per entry: sessions exporting at the same time
+    # cannot drop each other's entries (Step 1 keeps the latest per hash)
+    fd = os.open(HASH_INDEX_PATH, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    try:
+        os.write(fd, (json.dumps(entry) + "\n").encode())
+    finally:
+        os.close(fd)
+
+
 # ------------------------------------------------------------------
 # Bundle into ZIP: original, clean corrected, JSON
 # ------------------------------------------------------------------
 zip_buffer = BytesIO()
 with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-    # Original image
-    orig_buffer = BytesIO()
-    original_img.save(orig_buffer, format="PNG")
-    zipf.writestr(f"{base_name}.png", orig_buffer.getvalue())
+    # Original image (large scans: the uploaded file as-is, instead of decoding it again)
+    if st.session_state.get("decoded_rgb") is not None:
+        ext = os.path.splitext(st.session_state.image_path)[1]
+        zipf.write(st.session_state.image_path, f"{base_name}{ext}")
+    else:
+        orig_buffer = BytesIO()
+        original_img.save(orig_buffer, format="PNG")
+        zipf.writestr(f"{base_name}.png", orig_buffer.getvalue())
     
-    # Clean perspective-corrected image (NO overlay)
-    corrected_buffer = BytesIO()
-    clean_corrected_pil.save(corrected_buffer, format="PNG")
-    zipf.writestr(f"{base_name}_perspectivecorrected.png", corrected_buffer.getvalue())  # ← Clean corrected image (no suffix)
+    # Clean perspective-corrected image (NO overlay), encoded straight from the BGR array
+    _, corrected_png = cv2.imencode(".png", warped_bgr)
+    zipf.writestr(f"{base_name}_perspectivecorrected.png", corrected_png.tobytes())  # ← Clean corrected image (no suffix)
     
     # JSON
     zipf.writestr(f"{base_name}.json", json_str)
@@ -159,9 +190,24 @@ if st.download_button(
     use_container_width=True
 ):
     st.success("Export bundle downloaded successfully! (Contains clean corrected image)")
+    if "image_hash" in st.session_state:
+        record_in_hash_index()
 
 # Navigation
-col_left, _ = st.columns(2)
+col_left, col_right = st.columns(2)
 with col_left:
     if st.button("← Back to Annotation"):
-        st.switch_page("pages/5_Annotation_Grid.py")
\ No newline at end of file
+        st.switch_page("pages/5_Annotation_Grid.py")
+
+# Next tray in the upload queue (already decoded in the background by Step 1)
+queue = st.session_state.get("tray_queue", [])
+pos = st.session_state.get("queue_pos", 0)
+with col_right:
+    if pos + 1 < len(queue):
+        if st.button(f"Next Tray ({pos + 2}/{len(queue)}) →", type="primary", use_container_width=True):
+            st.session_state.previous_metadata = metadata
+            st.session_state.queue_pos = pos + 1
+            st.session_state.auto_advance = True
+            st.switch_page("pages/1_Upload_Image.py")
+    elif queue:
+        st.info(f"All {len(queue)} trays in this session are done.")
\ No newline at end of file